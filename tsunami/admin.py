@@ -1,12 +1,18 @@
+import functools
 import json
 
 from django.contrib import admin
+from django.contrib.admin.utils import quote
+from django.contrib.admin.views.main import ChangeList
+from django.core.signals import setting_changed
+from django.utils.encoding import iri_to_uri
 from django.utils.html import format_html
-from django.urls import reverse
+from django.urls import get_script_prefix, reverse
 from django.urls.exceptions import NoReverseMatch
 from django.contrib.contenttypes.models import ContentType
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.db import models
+from django.db.models.signals import post_delete, post_migrate, post_save
 
 from django_admin_listfilter_dropdown.filters import (
     DropdownFilter,
@@ -16,28 +22,123 @@ from django_admin_listfilter_dropdown.filters import (
 
 from rangefilter.filters import DateRangeFilter
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from .models import Event, EventAggregate
 
 
+def _format_json(data):
+    """
+    Returns the given data as indented JSON with sorted keys.
+
+    Uses orjson when it is available, falling back to the standard library for data
+    that orjson cannot serialize.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, option = orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS).decode()
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(data, indent = 2, sort_keys = True)
+
+
+@functools.lru_cache(maxsize = 1024)
+def _format_code(value):
+    """
+    Returns the given value escaped and wrapped in a code tag.
+
+    The same values, e.g. event types and content type labels, appear on many rows, so
+    the formatted values are cached.
+    """
+    return format_html('<code>{}</code>', value)
+
+
+# Placeholder for the object id in cached admin change URLs
+_OBJ_ID_PLACEHOLDER = '__obj_id__'
+
+
+@functools.lru_cache(maxsize = 512)
+def _change_url_template(app_label, model, script_prefix):
+    """
+    Returns the admin change URL for the given model with a placeholder for the object id,
+    or ``None`` if the model is not registered with the admin.
+
+    Resolving the URL is relatively expensive, so it is done once per model rather than
+    once per rendered link. The script prefix is part of the cache key as it is included
+    in the URL.
+    """
+    try:
+        return reverse(
+            'admin:{}_{}_change'.format(app_label, model),
+            args = (_OBJ_ID_PLACEHOLDER, )
+        )
+    except NoReverseMatch:
+        return None
+
+
 def _make_link(obj_or_ctype, obj_id = None):
     if obj_id is None:
-        ctype = ContentType.objects.get_for_model(obj_or_ctype)
+        # Use the same model that ContentType.objects.get_for_model would, but without
+        # going through the content type cache for every link
+        opts = obj_or_ctype._meta.concrete_model._meta
+        app_label, model = opts.app_label, opts.model_name
         obj_id = obj_or_ctype.pk
         link_text = str(obj_or_ctype)
     else:
-        ctype = obj_or_ctype
+        app_label, model = obj_or_ctype.app_label, obj_or_ctype.model
         link_text = obj_id
-    try:
-        return format_html(
-            '<a href="{}">{}</a>',
-            reverse(
-                'admin:{}_{}_change'.format(ctype.app_label, ctype.model),
-                args = (obj_id, )
-            ),
-            link_text
-        )
-    except NoReverseMatch:
+    url_template = _change_url_template(app_label, model, get_script_prefix())
+    if url_template is None:
         return str(link_text)
+    return format_html(
+        '<a href="{}">{}</a>',
+        # Escape the object id in the same way as reverse would
+        iri_to_uri(url_template.replace(_OBJ_ID_PLACEHOLDER, quote(str(obj_id)))),
+        link_text
+    )
+
+
+def _clear_url_caches(setting, **kwargs):
+    # The cached URLs depend on the URLconf
+    if setting == 'ROOT_URLCONF':
+        _change_url_template.cache_clear()
+
+
+setting_changed.connect(
+    _clear_url_caches,
+    dispatch_uid = '{}.{}'.format(_clear_url_caches.__module__, _clear_url_caches.__qualname__)
+)
+
+
+@functools.lru_cache(maxsize = None)
+def _ctype_choices():
+    """
+    Returns the choices for the content type filters.
+
+    Content types rarely change, so the choices are cached until a content type is
+    saved or deleted, or migrations are run.
+    """
+    return tuple(
+        (ct.pk, '{}.{}'.format(ct.app_label, ct.model))
+        for ct in ContentType.objects.all()
+    )
+
+
+def _clear_ctype_choices(**kwargs):
+    _ctype_choices.cache_clear()
+
+
+# Use the same dispatch uid for all the signals that clear the cache
+_CLEAR_CTYPE_CHOICES_UID = '{}.{}'.format(
+    _clear_ctype_choices.__module__,
+    _clear_ctype_choices.__qualname__
+)
+post_migrate.connect(_clear_ctype_choices, dispatch_uid = _CLEAR_CTYPE_CHOICES_UID)
+post_save.connect(_clear_ctype_choices, ContentType, dispatch_uid = _CLEAR_CTYPE_CHOICES_UID)
+post_delete.connect(_clear_ctype_choices, ContentType, dispatch_uid = _CLEAR_CTYPE_CHOICES_UID)
 
 
 class GfkContentTypeFilter(RelatedDropdownFilter):
@@ -47,10 +148,7 @@ class GfkContentTypeFilter(RelatedDropdownFilter):
     It will remove the configured id parameter when the content type changes.
     """
     def field_choices(self, field, request, model_admin):
-        return tuple(
-            (ct.pk, '{}.{}'.format(ct.app_label, ct.model))
-            for ct in ContentType.objects.all()
-        )
+        return _ctype_choices()
 
     def choices(self, changelist):
         # We override choices in order to remove the id parameter from the query string
@@ -102,26 +200,51 @@ class GfkIdFilter(admin.SimpleListFilter):
     """
     # Use the dropdown filter template
     template = 'django_admin_listfilter_dropdown/dropdown_filter.html'
+    # The maximum number of objects to offer as choices
+    max_choices = 500
 
     def __init__(self, request, params, model, model_admin):
         # Find the content type referred to by the related content type parameter
         self.content_type = None
         ctype_id = request.GET.get(self.ctype_parameter_name)
         if ctype_id:
+            # Use get_for_id so that the content type cache is used
             try:
-                self.content_type = ContentType.objects.get(pk = ctype_id)
-            except ObjectDoesNotExist:
+                self.content_type = ContentType.objects.get_for_id(int(ctype_id))
+            except (ValueError, ObjectDoesNotExist):
                 pass
         super().__init__(request, params, model, model_admin)
 
+    def _make_choices(self, model, queryset):
+        # If the model declares a field to use as the label, avoid loading full instances
+        label_field = getattr(model, 'event_label_field', None)
+        if label_field:
+            return tuple(
+                (pk, str(label))
+                for pk, label in queryset.values_list('pk', label_field)
+            )
+        else:
+            return tuple((obj.pk, str(obj)) for obj in queryset)
+
     def lookups(self, request, model_admin):
-        if not self.content_type:
+        model = self.content_type.model_class() if self.content_type else None
+        if model is None:
             return ()
-        # Display all the options for the selected ctype
-        return tuple(
-            (obj.pk, str(obj))
-            for obj in self.content_type.model_class().objects.all()
-        )
+        queryset = model._default_manager.all()
+        # Slicing requires a stable ordering
+        if not queryset.ordered:
+            queryset = queryset.order_by('pk')
+        # Display the options for the selected ctype, up to the maximum
+        choices = self._make_choices(model, queryset[:self.max_choices])
+        # Make sure that the selected object is available even if it is beyond the maximum
+        value = self.value()
+        if value and not any(str(pk) == value for pk, _ in choices):
+            try:
+                choices += self._make_choices(model, queryset.filter(pk = value))
+            except (ValueError, ValidationError):
+                # The value is not a valid primary key for the model
+                pass
+        return choices
 
     def queryset(self, request, queryset):
         if self.value():
@@ -154,13 +277,14 @@ class EventAggregateInline(admin.TabularInline):
     readonly_fields = ('aggregate_ctype_formatted', 'aggregate_link')
     exclude = ('aggregate_ctype', 'aggregate_id')
 
+    def get_queryset(self, request):
+        # Fetch the content types with the aggregates to avoid a query per row
+        return super().get_queryset(request).select_related('aggregate_ctype')
+
     def aggregate_ctype_formatted(self, obj):
         # Display the full label for the content type
-        return format_html(
-            '<code>{}.{}</code>',
-            obj.aggregate_ctype.app_label,
-            obj.aggregate_ctype.model
-        )
+        ctype = obj.aggregate_ctype
+        return _format_code('{}.{}'.format(ctype.app_label, ctype.model))
     aggregate_ctype_formatted.short_description = 'aggregate ctype'
 
     def aggregate_link(self, obj):
@@ -178,6 +302,14 @@ class EventAggregateInline(admin.TabularInline):
         return False
 
 
+class EventChangeList(ChangeList):
+    """
+    Changelist for events that does not load the event data, since it is not displayed.
+    """
+    def get_queryset(self, *args, **kwargs):
+        return super().get_queryset(*args, **kwargs).defer('data')
+
+
 @admin.register(Event)
 class EventAdmin(admin.ModelAdmin):
     list_display = (
@@ -214,22 +346,24 @@ class EventAdmin(admin.ModelAdmin):
 
     def get_queryset(self, request):
         # Annotate the queryset with information about the number of aggregates
-        qs = super().get_queryset(request)
+        # The related objects are also selected for the change view, where
+        # list_select_related does not apply
+        qs = super().get_queryset(request).select_related('target_ctype', 'user')
         return qs.annotate(
             num_aggregates = models.Count('aggregate')
         )
 
+    def get_changelist(self, request, **kwargs):
+        return EventChangeList
+
     def event_type_formatted(self, obj):
-        return format_html('<code>{}</code>', obj.event_type)
+        return _format_code(obj.event_type)
     event_type_formatted.short_description = 'event type'
 
     def target_ctype_formatted(self, obj):
         # Display the full label for the content type
-        return format_html(
-            '<code>{}.{}</code>',
-            obj.target_ctype.app_label,
-            obj.target_ctype.model
-        )
+        ctype = obj.target_ctype
+        return _format_code('{}.{}'.format(ctype.app_label, ctype.model))
     target_ctype_formatted.short_description = 'target ctype'
 
     def target_link(self, obj):
@@ -243,7 +377,7 @@ class EventAdmin(admin.ModelAdmin):
     def data_formatted(self, obj):
         return format_html(
             '<pre>{}</pre>',
-            json.dumps(obj.data, indent = 2, sort_keys = True)
+            _format_json(obj.data)
         )
     data_formatted.short_description = 'data'
 
@@ -17,12 +17,26 @@ class TsunamiAppConfig(AppConfig):
 
 
 # Patch the ModelAdmin history_view to point to the events for an object
+import functools
 from django.contrib.admin import ModelAdmin
 from django.contrib.admin.utils import unquote
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.utils.http import urlencode
 from django.core.exceptions import PermissionDenied
+from django.core.signals import setting_changed
+from django.urls import get_script_prefix
+@functools.lru_cache(maxsize = None)
+def _events_url(script_prefix):
+    # The URL of the events changelist only changes with the script prefix or the URLconf
+    return reverse('admin:tsunami_event_changelist')
+def _clear_events_url(setting, **kwargs):
+    if setting == 'ROOT_URLCONF':
+        _events_url.cache_clear()
+setting_changed.connect(
+    _clear_events_url,
+    dispatch_uid = '{}.{}'.format(_clear_events_url.__module__, _clear_events_url.__qualname__)
+)
 def history_redirect(model_admin, request, object_id, extra_context = None):
     # First, find the object that the history is for
     model = model_admin.model
@@ -33,8 +47,9 @@ def history_redirect(model_admin, request, object_id, extra_context = None):
         raise PermissionDenied
     # If we get this far, redirect to the tsunami events with the correct parameters
     from django.contrib.contenttypes.models import ContentType
-    ctype = ContentType.objects.get_for_model(obj)
-    events_url = reverse('admin:tsunami_event_changelist')
+    # The content type only depends on the model, and is cached by Django after the first lookup
+    ctype = ContentType.objects.get_for_model(model)
+    events_url = _events_url(get_script_prefix())
     qs = urlencode(dict(
         aggregate__aggregate_ctype__id__exact = ctype.pk,
         aggregate__aggregate_id = obj.pk
@@ -7,12 +7,28 @@ def event_listener(*event_types, **kwargs):
     """
     Decorator that registers a listener function for the given event types.
     """
+    # Use a set for fast membership checks when events are saved
+    event_types = frozenset(event_types)
     def decorator(listener):
         def signal_receiver(sender, instance, **kwargs):
             if instance.event_type in event_types:
                 listener(instance)
+        # Build the arguments for each listener, as the decorator may be used more than once
+        # The wrapper is a closure, so hold a strong reference by default
+        connect_kwargs = { 'weak': False }
+        # Use a dispatch uid derived from the listener so that importing the listener
+        # more than once does not result in it being called more than once per event
+        # Listeners defined inside a function can share a qualified name, so they do not
+        # get a default dispatch uid
+        if '<locals>' not in listener.__qualname__:
+            connect_kwargs['dispatch_uid'] = '{}.{}#{}'.format(
+                listener.__module__,
+                listener.__qualname__,
+                sorted(event_types)
+            )
+        connect_kwargs.update(kwargs)
         # Register the wrapper as a signal handler for the event model
-        post_save.connect(signal_receiver, Event, **kwargs)
+        post_save.connect(signal_receiver, Event, **connect_kwargs)
         # Return the signal receiver to allow weak references to be made
         return signal_receiver
     return decorator
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.30 on 2026-10-15 21:09
+
+from django.db import migrations, models
+
+
+def remove_duplicate_aggregates(apps, schema_editor):
+    """
+    Removes duplicate aggregates so that the unique constraint can be added, keeping the
+    aggregate with the lowest id for each event.
+    """
+    EventAggregate = apps.get_model('tsunami', 'EventAggregate')
+    aggregates = EventAggregate.objects.using(schema_editor.connection.alias)
+    duplicates = (
+        aggregates
+            .order_by()
+            .values('event', 'aggregate_ctype', 'aggregate_id')
+            .annotate(min_id = models.Min('id'), count = models.Count('id'))
+            .filter(count__gt = 1)
+    )
+    for duplicate in duplicates:
+        aggregates.filter(
+            event = duplicate['event'],
+            aggregate_ctype = duplicate['aggregate_ctype'],
+            aggregate_id = duplicate['aggregate_id']
+        ).exclude(id = duplicate['min_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tsunami', '0003_rename_event_target_ctype_target_id_tsunami_eve_target__db9ae6_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_aggregates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='eventaggregate',
+            constraint=models.UniqueConstraint(fields=('event', 'aggregate_ctype', 'aggregate_id'), name='tsunami_unique_event_aggregate'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-15 21:09
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tsunami', '0004_eventaggregate_unique'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='event',
+            name='event_type',
+            field=models.CharField(max_length=250, validators=[django.core.validators.RegexValidator('^[a-zA-Z0-9._@/-]+$')]),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['event_type', '-created_at'], name='tsunami_eve_event_t_99e4d8_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-15 21:34
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tsunami', '0005_event_type_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='event',
+            name='data',
+            field=models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder),
+        ),
+    ]
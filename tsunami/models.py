@@ -4,15 +4,15 @@ from django.db import models, router, transaction
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import RegexValidator
 
-from jsonfield import JSONField
-
 
 def _default_user():
     """
     Returns the user from the tracking state.
     """
+    # The tracking module imports the models, so it cannot be imported at module level
     from . import tracking
     return tracking.state.user
 
@@ -28,12 +28,24 @@ def _find_aggregates(instance):
     This is a recursive operation - the aggregates of an instance's aggregates
     are also aggregates of the instance.
     """
-    # The instance itself is always an aggregate
-    aggregates = set([instance])
-    # If the instance defines a get_event_aggregates method, use it
-    if hasattr(instance, 'get_event_aggregates'):
-        for aggregate in instance.get_event_aggregates():
-            aggregates.update(_find_aggregates(aggregate))
+    # Most models do not define any additional aggregates, in which case there is no
+    # graph to walk and the instance is the only aggregate
+    if not hasattr(type(instance), 'get_event_aggregates'):
+        return {instance}
+    # Walk the aggregate graph using a worklist so that each aggregate is only visited
+    # once, even if it is reachable via several paths
+    aggregates = set()
+    to_visit = [instance]
+    while to_visit:
+        aggregate = to_visit.pop()
+        if aggregate in aggregates:
+            continue
+        # The instance itself is always an aggregate
+        aggregates.add(aggregate)
+        # If the aggregate defines a get_event_aggregates method, use it
+        get_event_aggregates = getattr(aggregate, 'get_event_aggregates', None)
+        if get_event_aggregates is not None:
+            to_visit.extend(get_event_aggregates())
     return aggregates
 
 
@@ -45,6 +57,8 @@ class Event(models.Model):
         indexes = [
             # Make an index for the generic fk
             models.Index(fields=['target_ctype', 'target_id']),
+            # Make an index to support filtering by event type with the default ordering
+            models.Index(fields=['event_type', '-created_at']),
         ]
         ordering = ('-created_at', )
 
@@ -53,7 +67,7 @@ class Event(models.Model):
     # Event type is a free field - apps should know how to display their own events when required
     event_type = models.CharField(
         max_length = 250,
-        validators = (RegexValidator('^[a-zA-Z0-9.-_@\\/]+$'), )
+        validators = (RegexValidator(r'^[a-zA-Z0-9._@/-]+$'), )
     )
     # Every event has a target, which is a generic foreign key
     target_ctype = models.ForeignKey(ContentType, models.CASCADE)
@@ -61,7 +75,8 @@ class Event(models.Model):
     target_id = models.CharField(max_length = 40)
     target = GenericForeignKey('target_ctype', 'target_id')
     # Event data is stored as a JSON blob
-    data = JSONField(default = dict)
+    # Use the Django encoder so that applications can include values such as dates in their events
+    data = models.JSONField(default = dict, encoder = DjangoJSONEncoder)
     # Events can optionally have an associated user
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -76,6 +91,27 @@ class Event(models.Model):
     def short_id(self):
         return str(self.id)[:8]
 
+    def _make_aggregates(self, target = None):
+        """
+        Returns unsaved aggregate objects for the event.
+
+        If the target is already known it can be given, otherwise it is fetched.
+        """
+        target = self.target if target is None else target
+        # If the target no longer exists, there is nothing to find aggregates for
+        if target is None:
+            return []
+        # Set the generic foreign key fields directly, rather than assigning the aggregate,
+        # so that the aggregate objects are not cached on the aggregates
+        return [
+            EventAggregate(
+                event = self,
+                aggregate_ctype = ContentType.objects.get_for_model(aggregate),
+                aggregate_id = aggregate.pk
+            )
+            for aggregate in _find_aggregates(target)
+        ]
+
     def save(self, force_insert = False,
                    force_update = False,
                    using = None,
@@ -85,10 +121,13 @@ class Event(models.Model):
         using = using or router.db_for_write(self.__class__, instance = self)
         with transaction.atomic(using = using):
             super().save(force_insert, force_update, using, update_fields)
-            EventAggregate.objects.bulk_create([
-                EventAggregate(event = self, aggregate = aggregate)
-                for aggregate in _find_aggregates(self.target)
-            ])
+            EventAggregate.objects.bulk_create(
+                self._make_aggregates(),
+                # Cap the size of each INSERT for databases with parameter limits
+                batch_size = 500,
+                # If the event is saved again, don't duplicate the existing aggregates
+                ignore_conflicts = True
+            )
 
 
 class EventAggregate(models.Model):
@@ -102,6 +141,13 @@ class EventAggregate(models.Model):
             # Make an index for the generic fk
             models.Index(fields=['aggregate_ctype', 'aggregate_id']),
         ]
+        constraints = [
+            # Each aggregate should only be recorded once for an event
+            models.UniqueConstraint(
+                fields = ['event', 'aggregate_ctype', 'aggregate_id'],
+                name = 'tsunami_unique_event_aggregate'
+            ),
+        ]
         ordering = (
             'aggregate_ctype__app_label',
             'aggregate_ctype__model',
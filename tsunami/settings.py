@@ -1,3 +1,5 @@
+import functools
+
 from settings_object.appsettings import SettingsObject, Setting
 
 
@@ -33,27 +35,39 @@ class TsunamiSettings(SettingsObject):
     WHITELISTED_MODELS = Setting(default = None)
 
     def default_is_tracked(self):
+        # Read the settings once when the predicate is created rather than on every call
+        default_blacklisted_apps = frozenset(self.DEFAULT_BLACKLISTED_APPS)
+        default_blacklisted_models = frozenset(self.DEFAULT_BLACKLISTED_MODELS)
+        blacklisted_apps = frozenset(self.BLACKLISTED_APPS)
+        blacklisted_models = frozenset(self.BLACKLISTED_MODELS)
+        whitelisted_apps = frozenset(self.WHITELISTED_APPS or ())
+        whitelisted_models = frozenset(self.WHITELISTED_MODELS or ())
+        # If there are no whitelists, models are tracked unless they are blacklisted
+        track_by_default = self.WHITELISTED_MODELS is None and self.WHITELISTED_APPS is None
+
+        # The result for a model never changes, so it only needs to be computed once
+        @functools.lru_cache(maxsize = None)
         def is_tracked(model):
             opts = model._meta
             # The default blacklists take precedence over everything else
-            if opts.app_label in self.DEFAULT_BLACKLISTED_APPS:
+            if opts.app_label in default_blacklisted_apps:
                 return False
-            if opts.label in self.DEFAULT_BLACKLISTED_MODELS:
+            if opts.label in default_blacklisted_models:
                 return False
             # Model blacklisting overrides everything
-            if opts.label in self.BLACKLISTED_MODELS:
+            if opts.label in blacklisted_models:
                 return False
             # If the model is whitelisted, track it
-            if opts.label in (self.WHITELISTED_MODELS or []):
+            if opts.label in whitelisted_models:
                 return True
             # App blacklisting overrides app whitelisting
-            if opts.app_label in self.BLACKLISTED_APPS:
+            if opts.app_label in blacklisted_apps:
                 return False
             # If the app is whitelisted, track the model
-            if opts.app_label in (self.WHITELISTED_APPS or []):
+            if opts.app_label in whitelisted_apps:
                 return True
             # If we get this far, then the model will be tracked iff there are no whitelists
-            return self.WHITELISTED_MODELS is None and self.WHITELISTED_APPS is None
+            return track_by_default
         return is_tracked
 
     #: The predicate that determines if a model should be tracked
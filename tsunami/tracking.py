@@ -1,36 +1,162 @@
 import threading
 import json
 import contextlib
+import copy
+import datetime
+import decimal
 import functools
+import uuid
 
 from django.apps import apps
-from django.db.models.signals import post_init, post_save, m2m_changed, post_delete
-from django.core.serializers import serialize
+from django.contrib.contenttypes.models import ContentType
+from django.db import router, transaction
+from django.db.models.signals import post_init, pre_save, post_save, m2m_changed, post_delete
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.serializers.python import Serializer as PythonSerializer
+from django.core.signals import setting_changed
 
-from .models import Event
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from .models import Event, EventAggregate
 from .settings import app_settings
 
 
 # Use a thread-local to track the current user
 # This is populated by a middleware
+# Note that __slots__ must not be used, as slot values would be shared between threads
 class _State(threading.local):
     def __init__(self):
         self.user = None
         self.suspended = False
+        # Whether an instance is currently being serialized
+        self.serializing = False
+        # Events waiting to be saved, along with their aggregates, when batching
+        self.pending = None
+        # The index of the most recent pending event for each target
+        self.pending_targets = {}
 
 state = _State()
 
 # I'm not sure this is used anywhere and doesn't seem to work so maybe we remove?
-@contextlib.contextmanager
-def suspend():
+class suspend(contextlib.ContextDecorator):
     """
     Context manager that suspends creation of tracking events for the duration of the context.
     """
-    state.suspended = True
+    def __enter__(self):
+        state.suspended = True
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        state.suspended = False
+
+
+def _save_pending():
+    """
+    Saves the pending events and their aggregates using bulk inserts.
+    """
+    # Stop batching before the events are saved, so that any events produced by
+    # listeners to the saved events are saved directly rather than being lost
+    pending, state.pending = state.pending, None
+    state.pending_targets = {}
+    if not pending:
+        return
+    events = [event for event, _ in pending]
+    # Assume the events and event aggregates are saved in the same db
+    using = router.db_for_write(Event)
+    with transaction.atomic(using = using):
+        Event.objects.using(using).bulk_create(events, batch_size = 500)
+        EventAggregate.objects.using(using).bulk_create(
+            [aggregate for _, aggregates in pending for aggregate in aggregates],
+            batch_size = 500,
+            ignore_conflicts = True
+        )
+        # bulk_create does not send signals, so send post_save for each event
+        # in order for listeners to still be notified
+        for event in events:
+            post_save.send(
+                sender = Event,
+                instance = event,
+                created = True,
+                update_fields = None,
+                raw = False,
+                using = using
+            )
+
+
+@contextlib.contextmanager
+def batch():
+    """
+    Context manager that batches the tracking events created for the duration of the context.
+
+    Instead of being saved one at a time, the events are saved using bulk inserts when the
+    context exits. If the context exits with an exception, the pending events are discarded.
+    """
+    # If we are already batching, the outermost context saves the events
+    if state.pending is not None:
+        yield
+        return
+    state.pending = []
     try:
         yield
+        _save_pending()
     finally:
-        state.suspended = False
+        state.pending = None
+        state.pending_targets = {}
+
+
+def _make_event(event_type, instance, data):
+    """
+    Returns an unsaved event for the given target instance.
+    """
+    # Set the generic foreign key fields directly rather than assigning the target, so
+    # that the target is not cached on the event
+    return Event(
+        event_type = event_type,
+        target_ctype = ContentType.objects.get_for_model(instance),
+        target_id = instance.pk,
+        data = data
+    )
+
+
+def _save_event(event, target, coalesce_with = ()):
+    """
+    Saves the event for the given target, or adds it to the pending events when batching.
+
+    When batching, if the most recent pending event for the same target has one of the
+    event types in ``coalesce_with``, the event is merged into it instead.
+    """
+    # Attribute access on the thread-local state is relatively slow, so read it once
+    pending = state.pending
+    if pending is None:
+        # Cache the target so that it is not fetched again to find the aggregates
+        Event.target.set_cached_value(event, target)
+        event.save()
+        return
+    # Find the aggregates now, while the target is still in the state that produced the event
+    # They are saved later using bulk_create, which refuses to save cached objects that
+    # have since been deleted, so neither the target nor the aggregates are cached
+    aggregates = event._make_aggregates(target)
+    pending_targets = state.pending_targets
+    target_key = (event.target_ctype_id, str(event.target_id))
+    index = pending_targets.get(target_key)
+    if index is not None:
+        pending_event, pending_aggregates = pending[index]
+        if pending_event.event_type in coalesce_with:
+            pending_event.data.update(event.data)
+            # Add any aggregates that the pending event does not already have
+            existing = {
+                (aggregate.aggregate_ctype_id, str(aggregate.aggregate_id))
+                for aggregate in pending_aggregates
+            }
+            for aggregate in aggregates:
+                if (aggregate.aggregate_ctype_id, str(aggregate.aggregate_id)) not in existing:
+                    aggregate.event = pending_event
+                    pending_aggregates.append(aggregate)
+            return
+    pending_targets[target_key] = len(pending)
+    pending.append((event, aggregates))
 
 
 def mutable_signal_receiver(func):
@@ -43,6 +169,9 @@ def mutable_signal_receiver(func):
     """
     @functools.wraps(func)
     def wrapper(sender, instance, signal, **kwargs):
+        # Decorated signals are always muted while an instance is being serialized
+        if state.serializing:
+            return
         mute_signals = getattr(instance, app_settings.MUTE_SIGNALS_ATTR, False)
         if mute_signals is True:
             pass # Skip all signals
@@ -53,8 +182,7 @@ def mutable_signal_receiver(func):
     return wrapper
         
 
-@contextlib.contextmanager
-def mute_signals_for(instance, sigs):
+class mute_signals_for(contextlib.ContextDecorator):
     """
     Context manager to mute any decorated signals which run within.
     
@@ -67,10 +195,30 @@ def mute_signals_for(instance, sigs):
     If True, all decorated signals will be muted. Otherwise, provide a list of signals to mute,
     like [post_delete, post_save]
     """
-    try:
-        yield setattr(instance, app_settings.MUTE_SIGNALS_ATTR, sigs)
-    finally:
-        setattr(instance, app_settings.MUTE_SIGNALS_ATTR, False)
+    def __init__(self, instance, sigs):
+        self.instance = instance
+        self.sigs = sigs
+
+    def __enter__(self):
+        setattr(self.instance, app_settings.MUTE_SIGNALS_ATTR, self.sigs)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        setattr(self.instance, app_settings.MUTE_SIGNALS_ATTR, False)
+
+
+# The models whose changes are tracked
+# This is populated when tracking is enabled, so the predicate is evaluated once per model
+_tracked_models = frozenset()
+# Whether tracking is currently enabled
+_enabled = False
+
+
+@functools.lru_cache(maxsize = None)
+def _has_event_type_fn(model):
+    """
+    Returns whether the given model defines a get_event_type method.
+    """
+    return hasattr(model, 'get_event_type')
 
 
 def _event_type(instance, diff, default):
@@ -79,15 +227,52 @@ def _event_type(instance, diff, default):
     """
     # For a model that is tsunami-aware, give it a chance to set the event type based on the diff
     # If not, return the default with the model label as a namespace
-    event_type = None
-    if hasattr(instance, 'get_event_type'):
-        event_type = instance.get_event_type(diff)
+    # Whether the method exists is checked once per model rather than for every instance
+    # The method is still called on the instance so that it is bound in the normal way
+    event_type = instance.get_event_type(diff) if _has_event_type_fn(type(instance)) else None
     if event_type:
         return event_type
     else:
         return '{}.{}'.format(instance._meta.label_lower, default)
 
 
+@functools.lru_cache(maxsize = None)
+def _concrete_field_names(model):
+    """
+    Returns the names of the concrete, non-M2M fields for the given model.
+    """
+    return tuple(
+        f.name
+        for f in model._meta.get_fields()
+        if f.concrete and not f.many_to_many
+    )
+
+
+@functools.lru_cache(maxsize = None)
+def _serialized_fields(model):
+    """
+    Returns the fields of the given model whose values are included when it is serialized.
+    """
+    return tuple(
+        f
+        for f in model._meta.concrete_model._meta.local_fields
+        if f.serialize
+    )
+
+
+@functools.lru_cache(maxsize = None)
+def _m2m_field_names(model):
+    """
+    Returns a dictionary mapping (related model, through model) to the name of the
+    corresponding many-to-many field on the given model.
+    """
+    # Only the forward fields are included, as reverse relations do not have a through model
+    return {
+        (f.related_model, f.remote_field.through): f.name
+        for f in model._meta.many_to_many
+    }
+
+
 def _instance_as_dict(instance, fields = None):
     """
     Returns the instance as a dictionary.
@@ -95,77 +280,231 @@ def _instance_as_dict(instance, fields = None):
     # By default, use all fields except M2M as they require extra queries
     # This function is run for every tracked instance that is loaded from the DB, so extra
     # queries are not good for performance!
+    # The fields for each model are cached for the same reason
     if fields is None:
-        fields = tuple(
-            f.name
-            for f in instance._meta.get_fields()
-            if f.concrete and not f.many_to_many
-        )
+        fields = _concrete_field_names(type(instance))
     # Mute signals here so the serializer doesn't trigger recursive calling of the signals.
     # Note that only signals decorated with @mutable_signal_receiver are muted.
-    with mute_signals_for(instance.__class__, True):
-        # In order to get everything in the correct format, we serialize to JSON and then convert back
-        data = serialize('json', (instance, ), fields = fields)
-    return json.loads(data)[0]['fields']
+    # A thread-local flag is used rather than mute_signals_for, to avoid modifying the
+    # model class for every instance that is serialized
+    serializing, state.serializing = state.serializing, True
+    try:
+        # Use the Python serializer, which the JSON serializer is built on, to get the field
+        # values without encoding to and decoding from JSON
+        # Serializer instances hold state, so a new one is used for each call
+        data = PythonSerializer().serialize((instance, ), fields = fields)
+    finally:
+        state.serializing = serializing
+    return data[0]['fields']
+
 
+# The Django JSON encoder holds no state, so a single instance can be shared
+_json_encoder = DjangoJSONEncoder()
 
-def _instance_diff(instance, created = False):
+
+def _event_data(data):
     """
-    Returns a diff for the instance as a dict.
+    Returns the given instance data converted to JSON-compatible values for an event.
+    """
+    # Values such as dates and decimals are converted in the same way as the JSON serializer
+    # This is only done when an event is created, not for every tracked instance that is loaded
+    if orjson is not None:
+        try:
+            # Pass dates and times through to the Django encoder so the format is the same
+            return orjson.loads(
+                orjson.dumps(
+                    data,
+                    default = _json_encoder.default,
+                    option = orjson.OPT_PASSTHROUGH_DATETIME
+                )
+            )
+        except orjson.JSONEncodeError:
+            pass
+    return json.loads(json.dumps(data, cls = DjangoJSONEncoder))
+
+
+# Types whose values cannot be modified in-place, and so do not need to be copied
+_IMMUTABLE_TYPES = (
+    type(None),
+    bool,
+    int,
+    float,
+    decimal.Decimal,
+    str,
+    bytes,
+    datetime.date,
+    datetime.time,
+    datetime.timedelta,
+    uuid.UUID,
+)
+
+
+# Sentinel for fields that are not in a snapshot
+_MISSING = object()
+
+
+def _instance_snapshot(instance):
+    """
+    Returns the raw values of the loaded fields of the instance, keyed by field name.
+    """
+    snapshot = {}
+    loaded = instance.__dict__
+    for field in _serialized_fields(type(instance)):
+        # Deferred fields are skipped, as loading them would require a query
+        if field.attname not in loaded:
+            continue
+        value = loaded[field.attname]
+        # Copy mutable values, e.g. from JSON fields, so that in-place changes are detected
+        if not isinstance(value, _IMMUTABLE_TYPES):
+            value = copy.deepcopy(value)
+        snapshot[field.name] = value
+    return snapshot
+
+
+def _instance_diff(instance, created = False, update_fields = None):
+    """
+    Returns a diff for the instance as a dict of event data.
+
+    If ``update_fields`` is given, only those fields are considered.
     """
-    # Get the current state as a dict
-    state = _instance_as_dict(instance)
     # If the instance is brand new, just return the full instance
     if created:
-        return state
-    # Otherwise, since we are dealing with models, a simple single-level diff is enough
-    # We only return information about fields that are in the new state
-    previous = getattr(instance, '_tsunami_state', {})
-    return {
-        field: state[field]
-        for field in state
-        if field not in previous or state[field] != previous[field]
-    }
+        return _event_data(_instance_as_dict(instance))
+    previous = getattr(instance, '_tsunami_state', None)
+    # If there is no snapshot, e.g. because the instance was loaded while tracking was
+    # disabled, there is no way to know what has changed
+    # Rather than treating every field as changed, the diff is empty and no event is produced
+    if previous is None:
+        return {}
+    fields = _serialized_fields(type(instance))
+    # If the save was restricted to specific fields, the other fields cannot have changed
+    # update_fields may contain either field names or attribute names
+    if update_fields is not None:
+        fields = tuple(
+            f
+            for f in fields
+            if f.name in update_fields or f.attname in update_fields
+        )
+    # Since we are dealing with models, a simple single-level diff is enough
+    # Compare the raw values with the snapshot to find the fields that may have changed,
+    # so that only those fields are serialized
+    # Deferred fields that have been loaded since the snapshot was taken are added to the
+    # snapshot before saving, so any fields that are still missing from it, e.g. because
+    # the instance no longer exists in the database, are considered to have changed since
+    # _MISSING is not equal to any value
+    loaded = instance.__dict__
+    candidates = tuple(
+        field
+        for field in fields
+        # Fields that have never been loaded have not been changed
+        if field.attname in loaded and
+           previous.get(field.name, _MISSING) != loaded[field.attname]
+    )
+    if not candidates:
+        return {}
+    diff = _event_data(
+        _instance_as_dict(instance, fields = tuple(f.name for f in candidates))
+    )
+    # The raw values may differ even though the stored value is the same, e.g. when a
+    # string is assigned to a decimal field, so also serialize the snapshot values of the
+    # candidates and drop the fields whose serialized values have not changed
+    snapshotted = tuple(f for f in candidates if f.name in previous)
+    if snapshotted:
+        # Serialize the snapshot values using a copy of the instance
+        # Copying does not send post_init, so the copy has no effect on tracking
+        original = copy.copy(instance)
+        for field in snapshotted:
+            original.__dict__[field.attname] = previous[field.name]
+        original_data = _event_data(
+            _instance_as_dict(original, fields = tuple(f.name for f in snapshotted))
+        )
+        diff = {
+            name: value
+            for name, value in diff.items()
+            if original_data.get(name, _MISSING) != value
+        }
+    return diff
 
 
 @mutable_signal_receiver
 def post_init_receiver(sender, instance, **kwargs):
     """
     Handles the post_init signal for tracked models.
+
+    This receiver is only connected for tracked models.
     """
-    if not app_settings.IS_TRACKED_PREDICATE(sender):
-        return
-    # If the instance is loaded from the DB, store the initial serialized state
+    # Store a snapshot of the initial state
     # This will allow us to diff with the current state when we create an event
-    try:
-        # Try to serialize the instance - this will fail for new instances
-        instance._tsunami_state = _instance_as_dict(instance)
-    except ValueError:
-        pass
+    # The snapshot contains raw field values, as serializing every instance that is loaded
+    # is expensive and most instances are never saved
+    instance._tsunami_state = _instance_snapshot(instance)
 
 
-def post_save_receiver(sender, instance, created, **kwargs):
+def pre_save_receiver(sender, instance, using, update_fields = None, **kwargs):
     """
-    Handles the post_save signal by saving a create or update event for tracked instances.
+    Handles the pre_save signal by adding the stored values of any fields that were deferred
+    when the snapshot was taken, but have since been loaded or set, to the snapshot.
+
+    This receiver is only connected for tracked models.
     """
     if state.suspended:
         return
-    if not app_settings.IS_TRACKED_PREDICATE(sender):
+    # New instances are not diffed, and instances without a snapshot produce no diff
+    previous = getattr(instance, '_tsunami_state', None)
+    if previous is None or instance._state.adding:
+        return
+    loaded = instance.__dict__
+    missing = tuple(
+        field
+        for field in _serialized_fields(type(instance))
+        if field.attname in loaded and
+           field.name not in previous and
+           (
+               update_fields is None or
+               field.name in update_fields or
+               field.attname in update_fields
+           )
+    )
+    # This is only the case when deferred fields are used, so the extra query is rare
+    if not missing:
+        return
+    values = (
+        sender._base_manager
+            .using(using)
+            .filter(pk = instance.pk)
+            .values(*(field.attname for field in missing))
+            .first()
+    )
+    if values is not None:
+        previous.update({ field.name: values[field.attname] for field in missing })
+
+
+def post_save_receiver(sender, instance, created, update_fields = None, **kwargs):
+    """
+    Handles the post_save signal by saving a create or update event for tracked instances.
+
+    This receiver is only connected for tracked models.
+    """
+    if state.suspended:
         return
     # Only produce an event if the diff is non-empty
-    diff = _instance_diff(instance, created)
+    diff = _instance_diff(instance, created, update_fields)
     if diff:
-        Event.objects.create(
-            event_type = _event_type(instance, diff, 'created' if created else 'updated'),
-            target = instance,
-            data = diff
-        )
+        event_type = _event_type(instance, diff, 'created' if created else 'updated')
+        # When batching, repeated saves of the same instance can be combined into a single
+        # event with the same type, or a default update can be combined with a default create
+        coalesce_with = {event_type}
+        if event_type == '{}.updated'.format(sender._meta.label_lower):
+            coalesce_with.add('{}.created'.format(sender._meta.label_lower))
+        _save_event(_make_event(event_type, instance, diff), instance, coalesce_with)
 
 
 @mutable_signal_receiver
 def m2m_changed_receiver(sender, instance, action, reverse, model, pk_set, **kwargs):
     """
     Handles the m2m_changed signal by saving an update event for tracked instances.
+
+    This receiver is only connected for the through models of tracked models.
     """
     if state.suspended:
         return
@@ -176,43 +515,31 @@ def m2m_changed_receiver(sender, instance, action, reverse, model, pk_set, **kwa
     if reverse:
         return
     # If the instance should not be tracked, return
-    if not app_settings.IS_TRACKED_PREDICATE(instance.__class__):
+    # This can happen when the relation is inherited by a model that is not tracked
+    if type(instance) not in _tracked_models:
         return
     # Get the name of the many-to-many field for the relation
-    m2m_field = next(
-        (
-            f.name
-            for f in instance._meta.get_fields()
-            if f.many_to_many and
-               f.related_model == model and
-               f.remote_field.through == sender
-        ),
-        None
-    )
+    m2m_field = _m2m_field_names(type(instance)).get((model, sender))
     if m2m_field:
         # The diff is the serialized value of the single m2m field
-        diff = _instance_as_dict(instance, fields = (m2m_field, ))
-        Event.objects.create(
-            event_type = _event_type(instance, diff, 'updated'),
-            target = instance,
-            # The data is the serialized value of the single m2m field
-            data = diff
-        )
+        diff = _event_data(_instance_as_dict(instance, fields = (m2m_field, )))
+        # The data is the serialized value of the single m2m field
+        _save_event(_make_event(_event_type(instance, diff, 'updated'), instance, diff), instance)
 
 
 def post_delete_receiver(sender, instance, **kwargs):
     """
     Handles the post_delete signal by saving a deleted event for tracked instances.
+
+    This receiver is only connected for tracked models.
     """
     if state.suspended:
         return
-    if not app_settings.IS_TRACKED_PREDICATE(sender):
-        return
-    Event.objects.create(
-        event_type = '{}.deleted'.format(sender._meta.label_lower),
-        target = instance,
-        # When deleted, put the last known state in the event data
-        data = _instance_as_dict(instance)
+    # When deleted, put the last known state in the event data
+    data = _event_data(_instance_as_dict(instance))
+    _save_event(
+        _make_event('{}.deleted'.format(sender._meta.label_lower), instance, data),
+        instance
     )
 
 
@@ -223,21 +550,78 @@ def _dispatch_uid(receiver):
     return '{}.{}'.format(receiver.__module__, receiver.__qualname__)
 
 
+# Compute the dispatch uids once so that connecting and disconnecting use the same values
+_DISPATCH_UIDS = {
+    receiver: _dispatch_uid(receiver)
+    for receiver in (
+        post_init_receiver,
+        pre_save_receiver,
+        post_save_receiver,
+        m2m_changed_receiver,
+        post_delete_receiver,
+    )
+}
+
+
 def enable():
     """
     Connects the tracking signals, and so enables tracking.
     """
-    post_init.connect(post_init_receiver, dispatch_uid = _dispatch_uid(post_init_receiver))
-    post_save.connect(post_save_receiver, dispatch_uid = _dispatch_uid(post_save_receiver))
-    m2m_changed.connect(m2m_changed_receiver, dispatch_uid = _dispatch_uid(m2m_changed_receiver))
-    post_delete.connect(post_delete_receiver, dispatch_uid = _dispatch_uid(post_delete_receiver))
+    global _tracked_models, _enabled
+    # Disconnect the receivers first, so that models which are no longer tracked under
+    # the current settings are not left connected
+    disable()
+    # Evaluate the tracking predicate again in case the settings have changed
+    _tracked_models = frozenset(
+        model
+        for model in apps.get_models(include_auto_created = True)
+        if app_settings.IS_TRACKED_PREDICATE(model)
+    )
+    # Signals are sent very frequently, so the receivers are only connected for tracked
+    # models, meaning that untracked models do not pay the cost of calling the receivers
+    for model in _tracked_models:
+        post_init.connect(post_init_receiver, model, dispatch_uid = _DISPATCH_UIDS[post_init_receiver])
+        pre_save.connect(pre_save_receiver, model, dispatch_uid = _DISPATCH_UIDS[pre_save_receiver])
+        post_save.connect(post_save_receiver, model, dispatch_uid = _DISPATCH_UIDS[post_save_receiver])
+        post_delete.connect(
+            post_delete_receiver,
+            model,
+            dispatch_uid = _DISPATCH_UIDS[post_delete_receiver]
+        )
+        # The sender for m2m_changed is the through model of the relation
+        for (_, through) in _m2m_field_names(model):
+            m2m_changed.connect(
+                m2m_changed_receiver,
+                through,
+                dispatch_uid = _DISPATCH_UIDS[m2m_changed_receiver]
+            )
+    _enabled = True
 
 
 def disable():
     """
     Disconnects the tracking signals, and so disables tracking.
     """
-    post_init.disconnect(dispatch_uid = _dispatch_uid(post_init_receiver))
-    post_save.disconnect(dispatch_uid = _dispatch_uid(post_save_receiver))
-    m2m_changed.disconnect(dispatch_uid = _dispatch_uid(m2m_changed_receiver))
-    post_delete.disconnect(dispatch_uid = _dispatch_uid(post_delete_receiver))
+    global _tracked_models, _enabled
+    _tracked_models = frozenset()
+    _enabled = False
+    # Disconnect from all the models in case they were tracked under different settings
+    for model in apps.get_models(include_auto_created = True):
+        post_init.disconnect(sender = model, dispatch_uid = _DISPATCH_UIDS[post_init_receiver])
+        pre_save.disconnect(sender = model, dispatch_uid = _DISPATCH_UIDS[pre_save_receiver])
+        post_save.disconnect(sender = model, dispatch_uid = _DISPATCH_UIDS[post_save_receiver])
+        post_delete.disconnect(sender = model, dispatch_uid = _DISPATCH_UIDS[post_delete_receiver])
+        m2m_changed.disconnect(sender = model, dispatch_uid = _DISPATCH_UIDS[m2m_changed_receiver])
+
+
+def setting_changed_receiver(setting, **kwargs):
+    """
+    Handles the setting_changed signal by re-enabling tracking when the Tsunami settings
+    change, e.g. when using override_settings in tests.
+    """
+    # The tracked models are only computed when tracking is enabled
+    if setting == 'TSUNAMI' and _enabled:
+        enable()
+
+
+setting_changed.connect(setting_changed_receiver, dispatch_uid = _dispatch_uid(setting_changed_receiver))